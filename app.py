@@ -1,250 +1,200 @@
 #!/usr/bin/env python3
 # Streamlit UI – KLN Freight Invoice Extractor (Final Updated Version)
 
+import hashlib
 import io
+import multiprocessing
 import os
-import re
+import threading
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 
-import pdfplumber
-import pandas as pd
 import streamlit as st
-from openpyxl import Workbook
-
-# --------------------------------------------------------------
-# Extract numeric invoice ID from filename (e.g., "26693" or "26693A")
-# --------------------------------------------------------------
-def extract_invoice_id(filename: str):
-    name = filename.upper()
-    m = re.search(r"(\d{4,6}[A-Z]?)", name)
-    if m:
-        return m.group(1)
-    return filename
+import xlsxwriter
 
+from kln_parser import HEADERS, init_worker, parse_invoice_pdf_bytes
 
-# --------------------------------------------------------------
-# Extract currency from filename ONLY
-# --------------------------------------------------------------
-def extract_currency_from_filename(filename: str):
-    name = filename.upper()
-    if " CAD" in name:
-        return "CAD"
-    if " USD" in name:
-        return "USD"
-    if " EUR" in name:
-        return "EUR"
-    return None
-
-
-# --------------------------------------------------------------
-# REQUIRED COLUMN HEADERS (Your 13 fields)
-# --------------------------------------------------------------
-HEADERS = [
-    "Timestamp", "Filename", "Invoice_Date", "Currency", "Shipper",
-    "Weight_KG", "Volume_M3", "Chargeable_KG", "Chargeable_CBM",
-    "Pieces", "Subtotal", "Freight_Mode", "Freight_Rate"
-]
 
 # --------------------------------------------------------------
-# REGEX PATTERNS FOR KLN INVOICE
+# PER-FILE PARSE CACHE (survives Streamlit reruns and sessions)
 # --------------------------------------------------------------
-
-# Invoice Date
-INVOICE_DATE_PAT = re.compile(
-    r"INVOICE DATE[\s:\-A-Z\n]*?(\d{4}-\d{2}-\d{2})",
-    re.I
-)
-
-# Shipper Name
-SHIPPER_PAT = re.compile(
-    r"SHIPPER'S NAME\s*-\s*NOM DE L'EXP[ÉE]DITEUR\s*([\w\s\-\.,/&]+)",
-    re.I
-)
-
-# Packages
-PACKAGES_PAT = re.compile(r"(\d+)\s+PACKAGE\b", re.I)
-
-# Weight & Volume
-WEIGHT_PAT = re.compile(r"Gross Weight[:\s]+([\d.]+)\s*KG", re.I)
-VOL_PAT = re.compile(r"Volume Weight[:\s]+([\d.]+)\s*KG", re.I)
-
-# Subtotal (Total)
-SUBTOTAL_PAT = re.compile(
-    r"Total\s*[:\-]?\s*([\d,]+\.\d{2})\s*(USD|CAD|EUR)?",
-    re.I
-)
-
-# Freight Amount — LAST value on "AIR FREIGHT" line
-FREIGHT_AMOUNT_PAT = re.compile(
-    r"AIR FREIGHT[^\n]*?([\d,]+\.\d{2})\s*$",
-    re.I | re.M
-)
-
-
-# --------------------------------------------------------------
-# PDF PARSER (FINAL VERSION)
-# --------------------------------------------------------------
-def parse_invoice_pdf_bytes(data: bytes, filename: str) -> Optional[Dict[str, Any]]:
-
+PARSE_CACHE_SIZE = 256
+
+
+@st.cache_resource
+def parse_cache() -> "Tuple[threading.Lock, OrderedDict[Tuple[str, str], Dict[str, Any]]]":
+    # (sha256 of PDF bytes, filename) -> parsed row, least recent first.
+    # Shared by every session thread, so all access goes through the lock.
+    return threading.Lock(), OrderedDict()
+
+
+def cache_lookup(keys: List[Tuple[str, str]]) -> Dict[int, Dict[str, Any]]:
+    """{index: row} for every key already parsed; refreshes their LRU slot."""
+    lock, cache = parse_cache()
+    hits = {}
+    with lock:
+        for i, key in enumerate(keys):
+            row = cache.get(key)
+            if row is not None:
+                cache.move_to_end(key)
+                hits[i] = row
+    return hits
+
+
+def cache_store(key: Tuple[str, str], row: Dict[str, Any]):
+    lock, cache = parse_cache()
+    with lock:
+        cache[key] = row
+        cache.move_to_end(key)
+        while len(cache) > PARSE_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def parse_in_pool(
+    jobs: Dict[int, Tuple[bytes, str]]
+) -> Iterator[Tuple[int, Optional[Dict[str, Any]]]]:
+    """Parse {index: (data, filename)} in worker processes, yielding as each finishes."""
+    # Never fork the multi-threaded Streamlit server itself. Streamlit makes
+    # this script sys.modules["__main__"], so multiprocessing re-imports it
+    # (as __mp_main__, skipping main()) in every worker it starts. The
+    # forkserver preloads kln_parser (and pymupdf) once instead of the script;
+    # the spawn fallback re-runs the script's imports in each worker.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["kln_parser"])
+    else:
+        ctx = multiprocessing.get_context("spawn")
+    workers = min(len(jobs), os.cpu_count() or 1)
+    ex = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=ctx,
+        initializer=init_worker,
+    )
     try:
-        with pdfplumber.open(io.BytesIO(data)) as pdf:
-            text = "\n".join(p.extract_text() or "" for p in pdf.pages)
-
-        # -------- Invoice Date --------
-        inv_date = None
-        m = INVOICE_DATE_PAT.search(text)
-        if m:
-            inv_date = m.group(1).strip()
-
-        # -------- Currency (FROM FILENAME ONLY) --------
-        currency = extract_currency_from_filename(filename)
-
-        # -------- Shipper --------
-        shipper = None
-        m = SHIPPER_PAT.search(text)
-        if m:
-            shipper = m.group(1).strip()
-
-        # -------- Pieces --------
-        pieces = None
-        m = PACKAGES_PAT.search(text)
-        if m:
-            pieces = int(m.group(1))
-
-        # -------- Weight KG --------
-        weight = None
-        m = WEIGHT_PAT.search(text)
-        if m:
-            weight = float(m.group(1))
-
-        # -------- Volume Weight KG → convert to m³ --------
-        volume_m3 = None
-        m = VOL_PAT.search(text)
-        if m:
-            vol_kg = float(m.group(1))
-            volume_m3 = vol_kg / 167.0
-
-        # -------- Chargeable KG --------
-        chargeable_kg = None
-        if weight and volume_m3:
-            chargeable_kg = max(weight, volume_m3 * 167)
-
-        # -------- Chargeable CBM --------
-        chargeable_cbm = volume_m3
-
-        # -------- Freight Amount (correct) --------
-        f_mode = None
-        f_rate = None
-
-        m = FREIGHT_AMOUNT_PAT.search(text)
-        if m:
-            f_mode = "Air"
-            f_rate = float(m.group(1).replace(",", ""))
-
-        # -------- Subtotal --------
-        subtotal = None
-        m = SUBTOTAL_PAT.search(text)
-        if m:
-            subtotal = float(m.group(1).replace(",", ""))
-
-        # -------- Build Row --------
-        return {
-            "Timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            # Only invoice ID (number), not full filename
-            "Filename": extract_invoice_id(filename),
-            "Invoice_Date": inv_date,
-            "Currency": currency,
-            "Shipper": shipper,
-            "Weight_KG": weight,
-            "Volume_M3": volume_m3,
-            "Chargeable_KG": chargeable_kg,
-            "Chargeable_CBM": chargeable_cbm,
-            "Pieces": pieces,
-            "Subtotal": subtotal,
-            "Freight_Mode": f_mode,
-            "Freight_Rate": f_rate,
-        }
-
-    except Exception:
-        traceback.print_exc()
-        return None
+        futures = {}
+        try:
+            for i, (data, name) in jobs.items():
+                futures[ex.submit(parse_invoice_pdf_bytes, data, name)] = i
+        except BrokenProcessPool:
+            traceback.print_exc()
+
+        for fut in as_completed(futures):
+            try:
+                row = fut.result()
+            except BrokenProcessPool:
+                # A worker died (MuPDF abort, OOM, initializer failure):
+                # fail the unfinished files, not the whole batch
+                traceback.print_exc()
+                row = None
+            yield futures[fut], row
+
+        # Jobs never submitted because the pool broke first
+        for i in jobs.keys() - set(futures.values()):
+            yield i, None
+    finally:
+        # Also runs when Streamlit stops/reruns mid-batch and closes this
+        # generator: drop the queued PDFs instead of waiting on all of them
+        ex.shutdown(wait=False, cancel_futures=True)
+
+
+def build_xlsx(rows: List[Dict[str, Any]]) -> bytes:
+    output = io.BytesIO()
+    # constant_memory flushes each row as soon as the next one starts
+    wb = xlsxwriter.Workbook(output, {"constant_memory": True})
+    ws = wb.add_worksheet("Invoices")
+    ws.write_row(0, 0, HEADERS)
+
+    for i, r in enumerate(rows, start=1):
+        ws.write_row(i, 0, [r.get(h) for h in HEADERS])
+
+    wb.close()
+    return output.getvalue()
 
 
 # --------------------------------------------------------------
 # STREAMLIT UI
 # --------------------------------------------------------------
-st.set_page_config(
-    page_title="KLN Invoice Extractor",
-    page_icon="📄",
-    layout="wide",
-)
-
-st.title("📄 KLN Freight Invoice → Excel Extractor")
-st.caption("Upload KLN freight invoices → Auto-extract → Download Excel.")
-
-uploads = st.file_uploader(
-    "Upload KLN PDF files",
-    type=["pdf"],
-    accept_multiple_files=True,
-)
-
-extract_btn = st.button("Extract Invoices", type="primary", disabled=not uploads)
-
-if extract_btn and uploads:
-
-    rows = []
-    progress = st.progress(0)
-    status = st.empty()
-    total = len(uploads)
-
-    for i, f in enumerate(uploads, start=1):
-        status.write(f"Parsing: **{f.name}**")
-        data = f.read()
-
-        row = parse_invoice_pdf_bytes(data, f.name)
-
-        if row:
-            rows.append(row)
-        else:
-            st.warning(f"❌ Could not extract from {f.name}")
-
-        progress.progress(i / total)
-
-    if rows:
+def main():
+    # Guarded so worker processes, which re-import this script as
+    # __mp_main__, never build the UI
+    st.set_page_config(
+        page_title="KLN Invoice Extractor",
+        page_icon="📄",
+        layout="wide",
+    )
+
+    st.title("📄 KLN Freight Invoice → Excel Extractor")
+    st.caption("Upload KLN freight invoices → Auto-extract → Download Excel.")
+
+    uploads = st.file_uploader(
+        "Upload KLN PDF files",
+        type=["pdf"],
+        accept_multiple_files=True,
+    )
+
+    extract_btn = st.button("Extract Invoices", type="primary", disabled=not uploads)
+
+    if extract_btn and uploads:
+
+        rows = []
+        progress = st.progress(0)
+        status = st.empty()
+        total = len(uploads)
+
+        # One run timestamp shared by every row in the batch
+        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        names = [f.name for f in uploads]
+        payloads = [f.getvalue() for f in uploads]
+
+        # Reuse rows for files parsed before; only send the misses to the pool
+        keys = [(hashlib.sha256(data).hexdigest(), name) for data, name in zip(payloads, names)]
+        results: Dict[int, Optional[Dict[str, Any]]] = dict(cache_lookup(keys))
+        jobs = {
+            i: (payloads[i], names[i]) for i in range(total) if i not in results
+        }
 
-        df = pd.DataFrame(rows)
+        done = len(results)
+        progress.progress(done / total)
 
-        # Ensure all columns exist
-        for col in HEADERS:
-            if col not in df.columns:
-                df[col] = None
+        if jobs:
+            for i, row in parse_in_pool(jobs):
+                results[i] = row
+                if row:
+                    cache_store(keys[i], row)
 
-        df = df[HEADERS]
+                done += 1
+                status.write(f"Parsed: **{names[i]}**")
+                progress.progress(done / total)
 
-        st.subheader("Preview")
-        st.dataframe(df, use_container_width=True)
+        for i, name in enumerate(names):
+            row = results[i]
+            if row:
+                rows.append({"Timestamp": ts, **row})
+            else:
+                st.warning(f"❌ Could not extract from {name}")
 
-        # Build Excel output
-        output = io.BytesIO()
-        wb = Workbook()
-        ws = wb.active
-        ws.append(HEADERS)
+        if rows:
 
-        for _, r in df.iterrows():
-            ws.append([r[h] for h in HEADERS])
+            # Preview straight from the row dicts (no DataFrame copy)
+            st.subheader("Preview")
+            st.dataframe(rows, column_order=HEADERS, use_container_width=True)
 
-        wb.save(output)
-        output.seek(0)
+            # Build Excel output (streamed straight from rows, no DataFrame)
+            output = build_xlsx(rows)
 
-        st.success(f"✔ Extraction complete ({len(rows)} invoices).")
+            st.success(f"✔ Extraction complete ({len(rows)} invoices).")
 
-        st.download_button(
-            "⬇️ Download Invoice_Summary.xlsx",
-            data=output,
-            file_name="Invoice_Summary.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
+            st.download_button(
+                "⬇️ Download Invoice_Summary.xlsx",
+                data=output,
+                file_name="Invoice_Summary.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
 
 
+if __name__ == "__main__":
+    main()
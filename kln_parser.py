@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# KLN Freight Invoice parser – regexes + PDF text extraction.
+# Kept out of app.py so Streamlit reruns reuse the compiled patterns and
+# worker processes can import (and pickle) parse_invoice_pdf_bytes.
+
+import logging
+import re
+import traceback
+from typing import Dict, Any, List, Optional
+
+import pymupdf
+
+# pdfminer/pdfplumber log per token at DEBUG; keep them quiet in case any
+# dependency still pulls them in
+for _noisy in ("pdfminer", "pdfplumber"):
+    logging.getLogger(_noisy).setLevel(logging.ERROR)
+
+# --------------------------------------------------------------
+# Extract numeric invoice ID from filename (e.g., "26693" or "26693A")
+# --------------------------------------------------------------
+def extract_invoice_id(filename: str):
+    name = filename.upper()
+    m = re.search(r"(\d{4,6}[A-Z]?)", name)
+    if m:
+        return m.group(1)
+    return filename
+
+
+# --------------------------------------------------------------
+# Extract currency from filename ONLY
+# --------------------------------------------------------------
+def extract_currency_from_filename(filename: str):
+    name = filename.upper()
+    if " CAD" in name:
+        return "CAD"
+    if " USD" in name:
+        return "USD"
+    if " EUR" in name:
+        return "EUR"
+    return None
+
+
+# --------------------------------------------------------------
+# Parse "1,234.56" → 1234.56 (C-level comma strip via translate)
+# --------------------------------------------------------------
+DROP_COMMAS = str.maketrans("", "", ",")
+
+
+def parse_amount(s: str) -> float:
+    return float(s.translate(DROP_COMMAS))
+
+
+# --------------------------------------------------------------
+# REQUIRED COLUMN HEADERS (Your 13 fields)
+# --------------------------------------------------------------
+HEADERS = [
+    "Timestamp", "Filename", "Invoice_Date", "Currency", "Shipper",
+    "Weight_KG", "Volume_M3", "Chargeable_KG", "Chargeable_CBM",
+    "Pieces", "Subtotal", "Freight_Mode", "Freight_Rate"
+]
+
+# --------------------------------------------------------------
+# REGEX PATTERNS FOR KLN INVOICE
+# --------------------------------------------------------------
+
+# Invoice Date
+INVOICE_DATE_PAT = re.compile(
+    r"INVOICE DATE[\s:\-A-Z\n]*?(\d{4}-\d{2}-\d{2})",
+    re.I
+)
+
+# Shipper Name — rest of a single line, capped to bound backtracking
+SHIPPER_PAT = re.compile(
+    r"SHIPPER'S NAME\s*-\s*NOM DE L'EXP[ÉE]DITEUR\s*([^\n]{1,120})",
+    re.I
+)
+
+# Packages
+PACKAGES_PAT = re.compile(r"(\d+)\s+PACKAGE\b", re.I)
+
+# Weight & Volume
+WEIGHT_PAT = re.compile(r"Gross Weight[:\s]+([\d.]+)\s*KG", re.I)
+VOL_PAT = re.compile(r"Volume Weight[:\s]+([\d.]+)\s*KG", re.I)
+
+# Subtotal (Total)
+SUBTOTAL_PAT = re.compile(
+    r"Total\s*[:\-]?\s*([\d,]+\.\d{2})\s*(USD|CAD|EUR)?",
+    re.I
+)
+
+# Freight Amount — LAST value on "AIR FREIGHT" line
+FREIGHT_AMOUNT_PAT = re.compile(
+    r"AIR FREIGHT[^\n]*?([\d,]+\.\d{2})\s*$",
+    re.I | re.M
+)
+
+# Field name -> pattern. Each is searched on its own: a combined
+# alternation would stop sre using each pattern's literal-prefix skip.
+FIELD_PATS = {
+    "inv_date": INVOICE_DATE_PAT,
+    "shipper": SHIPPER_PAT,
+    "pieces": PACKAGES_PAT,
+    "weight": WEIGHT_PAT,
+    "volume": VOL_PAT,
+    "subtotal": SUBTOTAL_PAT,
+    "freight": FREIGHT_AMOUNT_PAT,
+}
+
+
+# Header fields sit in the first lines; totals near the bottom
+HEAD_LINES = 200
+TAIL_LINES = 80
+TAIL_FIELDS = ("subtotal", "freight")
+
+
+# Hot helpers bind their globals as keyword defaults (LOAD_FAST lookups)
+def scan_fields(
+    text: str, *, _searches=tuple((name, pat.search) for name, pat in FIELD_PATS.items())
+) -> Dict[str, re.Match]:
+    """First match of every FIELD_PATS pattern; misses are left out."""
+    found: Dict[str, re.Match] = {}
+    for name, search in _searches:
+        m = search(text)
+        if m:
+            found[name] = m
+    return found
+
+
+def find_fields(text: str, *, _scan=scan_fields, _pats=FIELD_PATS) -> Dict[str, re.Match]:
+    """Scan the header window first; only search further for misses.
+
+    On long text, a total missing from the header window is taken from
+    the last TAIL_LINES lines first, i.e. the bottom-most block may win
+    over an earlier "Total" in the middle of the document.
+    """
+    # Usual case (page 1, maybe the last page): short enough to scan whole
+    if text.count("\n") < HEAD_LINES:
+        return _scan(text)
+
+    lines = text.split("\n")
+    found = _scan("\n".join(lines[:HEAD_LINES]))
+
+    # Totals: try the bottom of the document before the full text
+    missing = [name for name in TAIL_FIELDS if name not in found]
+    if missing:
+        tail = "\n".join(lines[-TAIL_LINES:])
+        for name in missing:
+            m = _pats[name].search(tail)
+            if m:
+                found[name] = m
+
+    for name, pat in _pats.items():
+        if name not in found:
+            m = pat.search(text)
+            if m:
+                found[name] = m
+    return found
+
+
+# --------------------------------------------------------------
+# PAGE TEXT — one line per visual row (as pdfplumber produced)
+# --------------------------------------------------------------
+# PyMuPDF's plain get_text() emits table cells block by block, so
+# "AIR FREIGHT" and its amount land on separate lines. The regexes
+# expect pdfplumber-style rows, so rebuild them from word boxes.
+LINE_TOLERANCE = 3  # pt between word tops, pdfplumber's y_tolerance
+
+
+def page_text(page) -> str:
+    # (x0, y0, x1, y1, word, block_no, line_no, word_no)
+    words = sorted(page.get_text("words"), key=lambda w: (w[1], w[0]))
+
+    rows: List[List[tuple]] = []
+    top = None
+    for w in words:
+        if top is None or w[1] - top > LINE_TOLERANCE:
+            rows.append([])
+        rows[-1].append(w)
+        top = w[1]
+
+    return "\n".join(
+        " ".join(w[4] for w in sorted(row, key=lambda w: w[0])) for row in rows
+    )
+
+
+# --------------------------------------------------------------
+# PDF PARSER (FINAL VERSION)
+# --------------------------------------------------------------
+def parse_invoice_pdf_bytes(
+    data: bytes, filename: str, *,
+    _sub=SUBTOTAL_PAT.search, _find=find_fields,
+) -> Optional[Dict[str, Any]]:
+
+    try:
+        with pymupdf.open(stream=data, filetype="pdf") as doc:
+            # Header + totals sit on page 1; only read the last page
+            # when the total isn't there (consolidated invoices)
+            text = page_text(doc[0])
+            if len(doc) > 1 and _sub(text) is None:
+                text += "\n" + page_text(doc[-1])
+
+        fields = _find(text)
+
+        # -------- Invoice Date --------
+        inv_date = None
+        m = fields.get("inv_date")
+        if m:
+            inv_date = m.group(1).strip()
+
+        # -------- Currency (FROM FILENAME ONLY) --------
+        currency = extract_currency_from_filename(filename)
+
+        # -------- Shipper --------
+        shipper = None
+        m = fields.get("shipper")
+        if m:
+            shipper = m.group(1).strip()
+
+        # -------- Pieces --------
+        pieces = None
+        m = fields.get("pieces")
+        if m:
+            pieces = int(m.group(1))
+
+        # -------- Weight KG --------
+        weight = None
+        m = fields.get("weight")
+        if m:
+            weight = float(m.group(1))
+
+        # -------- Volume Weight KG → convert to m³ --------
+        volume_m3 = None
+        m = fields.get("volume")
+        if m:
+            vol_kg = float(m.group(1))
+            volume_m3 = vol_kg / 167.0
+
+        # -------- Chargeable KG --------
+        chargeable_kg = None
+        if weight and volume_m3:
+            chargeable_kg = max(weight, volume_m3 * 167)
+
+        # -------- Chargeable CBM --------
+        chargeable_cbm = volume_m3
+
+        # -------- Freight Amount (correct) --------
+        f_mode = None
+        f_rate = None
+
+        m = fields.get("freight")
+        if m:
+            f_mode = "Air"
+            f_rate = parse_amount(m.group(1))
+
+        # -------- Subtotal --------
+        subtotal = None
+        m = fields.get("subtotal")
+        if m:
+            subtotal = parse_amount(m.group(1))
+
+        # -------- Build Row (Timestamp is stamped per run by the UI) --------
+        return {
+            # Only invoice ID (number), not full filename
+            "Filename": extract_invoice_id(filename),
+            "Invoice_Date": inv_date,
+            "Currency": currency,
+            "Shipper": shipper,
+            "Weight_KG": weight,
+            "Volume_M3": volume_m3,
+            "Chargeable_KG": chargeable_kg,
+            "Chargeable_CBM": chargeable_cbm,
+            "Pieces": pieces,
+            "Subtotal": subtotal,
+            "Freight_Mode": f_mode,
+            "Freight_Rate": f_rate,
+        }
+
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+# --------------------------------------------------------------
+# WORKER PROCESS SETUP (once per worker, not per PDF)
+# --------------------------------------------------------------
+def init_worker():
+    # MuPDF prints every recoverable PDF error to stderr; on hosted
+    # deployments that log capture costs more than the parse itself
+    pymupdf.TOOLS.mupdf_display_errors(False)
+    pymupdf.TOOLS.mupdf_display_warnings(False)
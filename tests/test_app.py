@@ -0,0 +1,59 @@
+import threading
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    app.parse_cache.clear()
+    monkeypatch.setattr(app, "PARSE_CACHE_SIZE", 2)
+    yield
+    app.parse_cache.clear()
+
+
+def key(n):
+    return (f"sha{n}", f"{n}.pdf")
+
+
+def test_cache_lookup_returns_hits_by_index():
+    app.cache_store(key(1), {"Filename": "1"})
+
+    assert app.cache_lookup([key(0), key(1)]) == {1: {"Filename": "1"}}
+
+
+def test_cache_evicts_least_recently_used():
+    app.cache_store(key(1), {"Filename": "1"})
+    app.cache_store(key(2), {"Filename": "2"})
+    app.cache_lookup([key(1)])  # 1 is now newer than 2
+    app.cache_store(key(3), {"Filename": "3"})
+
+    assert app.cache_lookup([key(1), key(2), key(3)]) == {
+        0: {"Filename": "1"},
+        2: {"Filename": "3"},
+    }
+
+
+def test_cache_is_safe_across_session_threads():
+    errors = []
+
+    def session(n):
+        try:
+            for j in range(500):
+                app.cache_store(key((n + j) % 5), {"Filename": str(j)})
+                app.cache_lookup([key(k) for k in range(5)])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=session, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    _, cache = app.parse_cache()
+    assert len(cache) <= app.PARSE_CACHE_SIZE
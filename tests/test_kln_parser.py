@@ -0,0 +1,172 @@
+import io
+
+import pymupdf
+import pytest
+
+import kln_parser
+from kln_parser import (
+    FIELD_PATS, HEAD_LINES, SUBTOTAL_PAT, TAIL_LINES, find_fields, page_text,
+    parse_invoice_pdf_bytes, scan_fields,
+)
+
+# Page-1 text laid out the way a KLN invoice extracts
+SAMPLE_TEXT = """KERRY LOGISTICS NETWORK
+INVOICE DATE: 2024-05-01
+SHIPPER'S NAME - NOM DE L'EXPÉDITEUR
+ACME Co., Ltd
+12 PACKAGE
+Gross Weight: 120.5 KG
+Volume Weight: 200 KG
+AIR FREIGHT 200.00 KG @ 3.50 1,234.00
+Sub Total: 2,345.67 CAD
+Total 9.99
+"""
+
+
+def separate_searches(text):
+    found = {}
+    for name, pat in FIELD_PATS.items():
+        m = pat.search(text)
+        if m:
+            found[name] = m
+    return found
+
+
+def spans(found):
+    return {name: (m.span(), m.groups()) for name, m in found.items()}
+
+
+def test_scan_fields_matches_separate_searches():
+    assert spans(scan_fields(SAMPLE_TEXT)) == spans(separate_searches(SAMPLE_TEXT))
+    assert set(scan_fields(SAMPLE_TEXT)) == set(FIELD_PATS)
+
+
+def test_scan_fields_leaves_out_misses():
+    found = scan_fields("INVOICE DATE: 2024-05-01\n")
+    assert list(found) == ["inv_date"]
+    assert found["inv_date"].group(1) == "2024-05-01"
+
+
+def filler(n):
+    return "".join(f"line {i}\n" for i in range(n))
+
+
+def test_find_fields_short_text_scans_whole_text():
+    found = find_fields(SAMPLE_TEXT)
+    assert spans(found) == spans(separate_searches(SAMPLE_TEXT))
+
+
+def test_find_fields_long_text_prefers_header_window():
+    text = SAMPLE_TEXT + filler(HEAD_LINES) + "Total 1.00 USD\n"
+    assert find_fields(text)["subtotal"].group(1) == "2,345.67"
+
+
+def test_find_fields_long_text_takes_total_from_tail_first():
+    # Deliberate: past the header window, the bottom totals block wins
+    # over an earlier "Total" that a full-text search would return
+    text = (
+        filler(HEAD_LINES)
+        + "Total 1.00 USD\n"
+        + filler(TAIL_LINES)
+        + "AIR FREIGHT 3.50 1,234.00\n"
+        + "Total 2,345.67 CAD\n"
+    )
+    found = find_fields(text)
+    assert SUBTOTAL_PAT.search(text).group(1) == "1.00"
+    assert found["subtotal"].group(1) == "2,345.67"
+    assert found["freight"].group(1) == "1,234.00"
+
+
+HEADER_CELLS = [
+    (60, [(72, "KERRY LOGISTICS (CANADA) INC."), (400, "INVOICE DATE"), (480, "2024-05-01")]),
+    (90, [(72, "SHIPPER'S NAME - NOM DE L'EXPÉDITEUR")]),
+    (102, [(72, "ACME Co., Ltd")]),
+    (130, [(72, "12 PACKAGE"), (200, "Gross Weight: 120.5 KG"), (350, "Volume Weight: 200 KG")]),
+]
+
+TOTALS_CELLS = [
+    (170, [(72, "AIR FREIGHT"), (250, "200.00 KG"), (350, "3.50"), (480, "1,234.00")]),
+    (185, [(72, "FUEL SURCHARGE"), (480, "111.67")]),
+    (220, [(400, "Total"), (480, "2,345.67 CAD")]),
+]
+
+
+def make_invoice_pdf(pages=(HEADER_CELLS + TOTALS_CELLS,)):
+    """PDF with a KLN-style layout: label and amount cells of a row are
+    drawn separately, as on the real invoice tables. One page per entry
+    in pages (default: a single page with header and totals)."""
+    doc = pymupdf.open()
+    for cells in pages:
+        page = doc.new_page()
+        for y, row in cells:
+            for x, text in row:
+                page.insert_text((x, y), text, fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def groups(found):
+    return {name: m.groups() for name, m in found.items()}
+
+
+def test_page_text_matches_pdfplumber_fields():
+    pdfplumber = pytest.importorskip("pdfplumber")
+    data = make_invoice_pdf()
+
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        plumber_text = "\n".join(p.extract_text() or "" for p in pdf.pages)
+    with pymupdf.open(stream=data, filetype="pdf") as doc:
+        mupdf_text = page_text(doc[0])
+
+    assert groups(scan_fields(mupdf_text)) == groups(scan_fields(plumber_text))
+    assert set(scan_fields(mupdf_text)) == set(FIELD_PATS)
+
+
+def test_parse_invoice_pdf_bytes_reads_table_rows():
+    row = parse_invoice_pdf_bytes(make_invoice_pdf(), "26693 CAD.pdf")
+
+    assert row["Filename"] == "26693"
+    assert row["Invoice_Date"] == "2024-05-01"
+    assert row["Currency"] == "CAD"
+    assert row["Shipper"] == "ACME Co., Ltd"
+    assert row["Pieces"] == 12
+    assert row["Weight_KG"] == 120.5
+    assert row["Freight_Mode"] == "Air"
+    assert row["Freight_Rate"] == 1234.0
+    assert row["Subtotal"] == 2345.67
+
+
+def test_parse_invoice_pdf_bytes_reads_totals_from_last_page_only(monkeypatch):
+    middle = [(60, [(72, "CONTINUED")]), (100, [(400, "Total"), (480, "9.99 CAD")])]
+    data = make_invoice_pdf([HEADER_CELLS, middle, middle, TOTALS_CELLS])
+
+    read = []
+
+    def recording_page_text(page):
+        read.append(page.number)
+        return page_text(page)
+
+    monkeypatch.setattr(kln_parser, "page_text", recording_page_text)
+    row = parse_invoice_pdf_bytes(data, "26693 CAD.pdf")
+
+    assert read == [0, 3]
+    assert row["Invoice_Date"] == "2024-05-01"
+    assert row["Subtotal"] == 2345.67
+    assert row["Freight_Rate"] == 1234.0
+
+
+def test_parse_invoice_pdf_bytes_skips_last_page_when_total_on_first(monkeypatch):
+    data = make_invoice_pdf([HEADER_CELLS + TOTALS_CELLS, [(100, [(400, "Total"), (480, "9.99 CAD")])]])
+
+    read = []
+
+    def recording_page_text(page):
+        read.append(page.number)
+        return page_text(page)
+
+    monkeypatch.setattr(kln_parser, "page_text", recording_page_text)
+    row = parse_invoice_pdf_bytes(data, "26693 CAD.pdf")
+
+    assert read == [0]
+    assert row["Subtotal"] == 2345.67